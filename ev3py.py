@@ -20,7 +20,14 @@ Authors: Thiago Marzagao (tmarzagao at gmail dot com)
 See firmware source code (https://github.com/mindboards/ev3sources) for 
 info on the data types and opcodes used here.
 '''
+import asyncio
+import contextlib
+import functools
+import itertools
 import socket
+import struct
+import threading
+import types
 
 # globals
 PRIMPAR_SHORT = 0x00
@@ -33,47 +40,254 @@ PRIMPAR_VARIABEL = 0x40
 PRIMPAR_1_BYTE = 1
 PRIMPAR_2_BYTES = 2
 PRIMPAR_4_BYTES = 3
+DIRECT_COMMAND_REPLY = 0x00
+DIRECT_COMMAND_NO_REPLY = 0x80
+
+# opcodes
+_OP_OUTPUT_STOP = 0xA3
+_OP_OUTPUT_POWER = 0xA4
+_OP_OUTPUT_START = 0xA6
+_OP_OUTPUT_STEP_POWER = 0xAC
+_OP_OUTPUT_TIME_POWER = 0xAD
+_OP_OUTPUT_STEP_SYNC = 0xB0
+_OP_OUTPUT_CLR_COUNT = 0xB2
+_OP_INPUT_READ = 0x9A
+_OP_SOUND = 0x94
+
+# first byte of the long local constants
+_LC1_PREFIX = PRIMPAR_LONG | PRIMPAR_CONST | PRIMPAR_1_BYTE
+_LC2_PREFIX = PRIMPAR_LONG | PRIMPAR_CONST | PRIMPAR_2_BYTES
+_LC4_PREFIX = PRIMPAR_LONG | PRIMPAR_CONST | PRIMPAR_4_BYTES
+
+# precompiled packers for the local constants and global variables below
+_LC0_TABLE = [bytes([(v & PRIMPAR_VALUE) | PRIMPAR_SHORT | PRIMPAR_CONST])
+              for v in range(PRIMPAR_VALUE + 1)]
+_LC1 = struct.Struct('<BB').pack
+_LC2 = struct.Struct('<BH').pack
+_LC4 = struct.Struct('<BI').pack
+_GV0_TABLE = [bytes([(v & PRIMPAR_INDEX) | PRIMPAR_SHORT | PRIMPAR_VARIABEL 
+                     | PRIMPAR_GLOBAL])
+              for v in range(PRIMPAR_INDEX + 1)]
 
 def LC0(v):
     '''
     create 1-byte local constant
     '''
-    byte1 = ((v & PRIMPAR_VALUE) | PRIMPAR_SHORT | PRIMPAR_CONST)
-    return bytes([byte1])
+    return _LC0_TABLE[v & PRIMPAR_VALUE]
 
 def LC1(v):
     '''
     create 2-byte local constant
     '''    
-    byte1 = (PRIMPAR_LONG | PRIMPAR_CONST | PRIMPAR_1_BYTE)
-    byte2 = (v & 0xFF)
-    return bytes([byte1, byte2])
+    return _LC1(_LC1_PREFIX, v & 0xFF)
 
 def LC2(v):
     '''
     create 3-byte local constant
     '''    
-    byte1 = (PRIMPAR_LONG | PRIMPAR_CONST | PRIMPAR_2_BYTES)
-    byte2 = (v & 0xFF)
-    byte3 = ((v >> 8) & 0xFF)
-    return bytes([byte1, byte2, byte3])
+    return _LC2(_LC2_PREFIX, v & 0xFFFF)
 
 def LC4(v):
     '''
     create 5-byte local constant
     '''
-    byte1 = (PRIMPAR_LONG  | PRIMPAR_CONST | PRIMPAR_4_BYTES)
-    byte2 = (v & 0xFF)
-    byte3 = ((v >> 8) & 0xFF)
-    byte4 = ((v >> 16) & 0xFF)
-    byte5 = ((v >> 24) & 0xFF)
-    return bytes([byte1, byte2, byte3, byte4, byte5])
+    return _LC4(_LC4_PREFIX, v & 0xFFFFFFFF)
 
 def GV0(v):
     '''
     create 1-byte global variable
     '''
-    return bytes([((v & PRIMPAR_INDEX) | PRIMPAR_SHORT | PRIMPAR_VARIABEL | PRIMPAR_GLOBAL)])
+    return _GV0_TABLE[v & PRIMPAR_INDEX]
+
+# motor ports and stop modes
+_PORTS_TO_INT = {'a': 1, 'b': 2, 'c': 4, 'd': 8}
+STOP_BRAKE = 1
+STOP_COAST = 0
+_STOPS = {'brake': STOP_BRAKE, 'coast': STOP_COAST}
+
+# stop argument (name or STOP_* value) -> stop mode
+_STOP_MODES = {'brake': STOP_BRAKE, 'coast': STOP_COAST, 
+               STOP_BRAKE: STOP_BRAKE, STOP_COAST: STOP_COAST}
+
+# port bit by character code: 'a' -> 1, 'b' -> 2, 'c' -> 4, 'd' -> 8
+_PORTS_LUT = bytes(1 << (i - 97) if 97 <= i <= 100 else 0 for i in range(256))
+
+@functools.lru_cache(maxsize=64)
+def _ports_mask_of(ports):
+    '''
+    map motor ports (str or tuple) to their bitmask; the cache holds
+    the most recently used arguments, whatever their order or repeats
+    '''
+    mask = 0
+    for code in ''.join(ports).encode():
+        bit = _PORTS_LUT[code]
+        if not bit:
+            raise ValueError('invalid motor ports: {!r}'.format(ports))
+        mask |= bit
+    return mask
+
+def _ports_mask(ports):
+    '''
+    map motor ports to the bitmask the EV3 expects, e.g. 'bc' -> 6
+    '''
+    if isinstance(ports, PortGroup):
+        return ports.mask
+    return _ports_mask_of(ports if isinstance(ports, str) else tuple(ports))
+
+class PortGroup:
+
+    '''
+    motor ports checked and mapped to their bitmask once, so they can
+    be passed as ports to the ev3 methods in loops at no extra cost
+
+    ports: a, b, c, d, any combinations thereof
+        type: str or iterable
+    '''
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.mask = _ports_mask(ports)
+
+# whole-frame packers: message size, message counter, command type, vars
+# (header), then one field per opcode, LC0 and LC prefix/value; only
+# read_sensor asks the brick for a reply, all other commands are sent
+# as DIRECT_COMMAND_NO_REPLY so the brick sends nothing back
+_PACK_MOTOR_START = struct.Struct('<HHBH BBBBB BBB').pack
+_PACK_MOTOR_STOP = struct.Struct('<HHBH BBBB').pack
+_PACK_MOTOR_STEP = struct.Struct('<HHBH BBBBB BI BI BI B BBB').pack
+_PACK_TURN = struct.Struct('<HHBH BBBBB BH BI B').pack
+_PACK_CLEAR_TACHO = struct.Struct('<HHBH BBB').pack
+_PACK_READ_SENSOR = struct.Struct('<HHBH BBBBBB').pack
+_PACK_PLAY_TONE = struct.Struct('<HHBH BB BB BH BH').pack
+
+# position of the power value in a motor_start frame
+_MOTOR_START_POWER_OFFSET = 11
+
+# command builders: plain ints in, ready-to-send bytes out; ports is a
+# bitmask of motor ports (a=1, b=2, c=4, d=8) and stop is 1 (brake) or 
+# 0 (coast), all other arguments as in the ev3 methods of the same name;
+# the ones typically called over and over with the same arguments in
+# feedback loops remember their recent results
+
+@functools.lru_cache(maxsize=64)
+def build_motor_start_command(layer, ports, power):
+    '''
+    build the bytes of a motor_start command
+    '''
+    layer &= PRIMPAR_VALUE
+    ports &= PRIMPAR_VALUE
+    return _PACK_MOTOR_START(
+        0x0D, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_POWER, layer, ports, _LC1_PREFIX, power & 0xFF,
+        _OP_OUTPUT_START, layer, ports)
+
+@functools.lru_cache(maxsize=64)
+def build_motor_stop_command(layer, ports, stop):
+    '''
+    build the bytes of a motor_stop command
+    '''
+    return _PACK_MOTOR_STOP(
+        0x09, 1, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_STOP, layer & PRIMPAR_VALUE, ports & PRIMPAR_VALUE, 
+        stop & PRIMPAR_VALUE)
+
+def build_motor_degrees_command(layer, ports, power, ramp_up, degrees, 
+                                ramp_down, stop):
+    '''
+    build the bytes of a motor_degrees command
+    '''
+    layer &= PRIMPAR_VALUE
+    ports &= PRIMPAR_VALUE
+    return _PACK_MOTOR_STEP(
+        0x1D, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_STEP_POWER, layer, ports, _LC1_PREFIX, power & 0xFF,
+        _LC4_PREFIX, ramp_up & 0xFFFFFFFF, _LC4_PREFIX, degrees & 0xFFFFFFFF,
+        _LC4_PREFIX, ramp_down & 0xFFFFFFFF, stop & PRIMPAR_VALUE,
+        _OP_OUTPUT_START, layer, ports)
+
+def build_motor_time_command(layer, ports, power, ramp_up, time, ramp_down,
+                             stop):
+    '''
+    build the bytes of a motor_time command
+    '''
+    layer &= PRIMPAR_VALUE
+    ports &= PRIMPAR_VALUE
+    return _PACK_MOTOR_STEP(
+        0x1D, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_TIME_POWER, layer, ports, _LC1_PREFIX, power & 0xFF,
+        _LC4_PREFIX, ramp_up & 0xFFFFFFFF, _LC4_PREFIX, time & 0xFFFFFFFF,
+        _LC4_PREFIX, ramp_down & 0xFFFFFFFF, stop & PRIMPAR_VALUE,
+        _OP_OUTPUT_START, layer, ports)
+
+def build_motor_time_batch(ports, powers, times, stops, ramp_up=0, 
+                           ramp_down=0, layer=0):
+    '''
+    build the bytes of many motor_time commands at once (e.g. a whole
+    choreography), ready to go out with a single ev3.send_command
+
+    ports, powers, times, stops: one item per command, all of the same
+                                 length
+        type: iterables of int
+    '''
+    ports, powers, times, stops = (
+        tuple(ports), tuple(powers), tuple(times), tuple(stops))
+    if not len(ports) == len(powers) == len(times) == len(stops):
+        raise ValueError(
+            'ports, powers, times and stops differ in length: '
+            '{}, {}, {}, {}'.format(
+                len(ports), len(powers), len(times), len(stops)))
+    return b''.join(map(build_motor_time_command, itertools.repeat(layer),
+                        ports, powers, itertools.repeat(ramp_up), times,
+                        itertools.repeat(ramp_down), stops))
+
+def build_turn_degrees_command(layer, ports, speed, turn, degrees, stop):
+    '''
+    build the bytes of a turn_degrees command
+    '''
+    return _PACK_TURN(
+        0x13, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_STEP_SYNC, layer & PRIMPAR_VALUE, ports & PRIMPAR_VALUE,
+        _LC1_PREFIX, speed & 0xFF, _LC2_PREFIX, turn & 0xFFFF, 
+        _LC4_PREFIX, degrees & 0xFFFFFFFF, stop & PRIMPAR_VALUE)
+
+def build_turn_time_command(layer, ports, speed, turn, time, stop):
+    '''
+    build the bytes of a turn_time command
+    '''
+    return _PACK_TURN(
+        0x13, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_STEP_SYNC, layer & PRIMPAR_VALUE, ports & PRIMPAR_VALUE,
+        _LC1_PREFIX, speed & 0xFF, _LC2_PREFIX, turn & 0xFFFF, 
+        _LC4_PREFIX, time & 0xFFFFFFFF, stop & PRIMPAR_VALUE)
+
+@functools.lru_cache(maxsize=64)
+def build_clear_tacho_command(layer, ports):
+    '''
+    build the bytes of a clear_tacho command
+    '''
+    return _PACK_CLEAR_TACHO(
+        0x08, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_OUTPUT_CLR_COUNT, layer & PRIMPAR_VALUE, ports & PRIMPAR_VALUE)
+
+def build_read_sensor_command(layer, port):
+    '''
+    build the bytes of a read_sensor command
+    
+    port: 0, 1, 2, 3 (firmware numbering, i.e. sensor port - 1)
+    '''
+    return _PACK_READ_SENSOR(
+        0x0B, 0, DIRECT_COMMAND_REPLY, 1,
+        _OP_INPUT_READ, layer & PRIMPAR_VALUE, port & PRIMPAR_VALUE, 0, 0, 
+        GV0(0)[0])
+
+def build_play_tone_command(volume, frequency, duration):
+    '''
+    build the bytes of a play_tone command
+    '''
+    return _PACK_PLAY_TONE(
+        0x0F, 0, DIRECT_COMMAND_NO_REPLY, 0,
+        _OP_SOUND, 1, _LC1_PREFIX, volume & 0xFF, 
+        _LC2_PREFIX, frequency & 0xFFFF, _LC2_PREFIX, duration & 0xFFFF)
 
 class ev3:
 
@@ -92,9 +306,11 @@ class ev3:
         type: int
         obs.: sensor port
     ports: a, b, c, d, any combinations thereof
-        type: str or iterable
-        obs.: motor ports
-        examples: 'a', 'bcd', ['d', 'c'], ['a'], ('c', 'b')        
+        type: str or iterable or PortGroup
+        obs.: motor ports; create a PortGroup once outside of loops
+              to skip mapping the ports on every call
+        examples: 'a', 'bcd', ['d', 'c'], ['a'], ('c', 'b'), 
+                  PortGroup('bc')
     power: -100...+100
         type: int
         obs.: -100 is full power backward, 100 is full power forward
@@ -114,8 +330,8 @@ class ev3:
               CAREFUL! speed will adjust power to keep robot moving at
               constant pace regardless of load or obstacles, so it may
               damage your robot
-    stop: 'brake', 'coast'
-        type: str
+    stop: 'brake', 'coast', STOP_BRAKE, STOP_COAST
+        type: str or int
     time: 0...MAX
         type: int
         obs.: unit is milliseconds
@@ -133,22 +349,38 @@ class ev3:
                 opposite direction of the left motor (spin)
     '''
 
-    def __init__(self, host):
+    # read-only, kept for code that looked these up on the instance;
+    # the methods do not use them
+    ports_to_int = types.MappingProxyType(_PORTS_TO_INT)
+    stops = types.MappingProxyType(_STOPS)
+
+    def __init__(self, host, socket_options=()):
 
         '''
         data used in more than one method
+
+        host: MAC address of the EV3 brick
+            type: str
+        socket_options: (level, optname, value) triples
+            type: iterable
+            obs.: each one is passed as is to setsockopt() on the
+                  Bluetooth socket before connecting
         '''
 
-        self.ports_to_int = {'a': 1, 'b': 2, 'c': 4, 'd': 8}
-        self.stops = {'brake': 1, 'coast': 0}
         self._host = host
+        self._socket_options = list(socket_options)
+        self.brick = None
+        self._pending = None
+        self._reply_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
+    def __exit__(self, *exc_info):
         """
         closes the connection to the LEGO EV3
         """
-        if isinstance(self.brick, socket.socket):
-            self.brick.close()
+        self.disconnect()
 
     def _connect_bluetooth(self, host):
         """
@@ -157,9 +389,114 @@ class ev3:
         self.brick = socket.socket(socket.AF_BLUETOOTH,
                                      socket.SOCK_STREAM,
                                      socket.BTPROTO_RFCOMM)
+        for option in self._socket_options:
+            self.brick.setsockopt(*option)
         self.brick.connect((host, 1))
 
 
+    def _send(self, command):
+        """
+        Send a command to the EV3, or hold it back while inside batch()
+        """
+        if self._pending is None:
+            self.brick.sendall(command)
+        else:
+            self._pending += command
+
+    def _recv(self, size):
+        """
+        Read exactly size bytes from the EV3
+        """
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = self.brick.recv_into(view[received:])
+            if not count:
+                raise ConnectionError('connection to EV3 closed')
+            received += count
+        return data
+
+    def _send_with_pending(self, command):
+        """
+        Send a command together with anything held back by batch(), in
+        a single write
+        """
+        if self._pending:
+            pending, self._pending = self._pending, bytearray()
+            pending += command
+            self.brick.sendall(pending)
+        else:
+            self.brick.sendall(command)
+
+    def _query(self, command, size):
+        """
+        Send a command that expects a reply (together with anything held
+        back by batch()) and return the reply; only one such command is
+        in flight at a time, so replies always match their command
+        """
+        with self._reply_lock:
+            self._send_with_pending(command)
+            return self._recv(size)
+
+    async def _acquire_reply_lock(self):
+        """
+        Take the reply lock without blocking the event loop
+        """
+        if self._reply_lock.acquire(blocking=False):
+            return
+        acquired = asyncio.get_running_loop().run_in_executor(
+            None, self._reply_lock.acquire)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # the worker thread still gets the lock; hand it back
+            acquired.add_done_callback(lambda _: self._reply_lock.release())
+            raise
+
+    def _recv_reply(self, size):
+        """
+        Read the reply to a command sent by read_sensor_async and release
+        the reply lock (runs in a worker thread)
+        """
+        try:
+            return self._recv(size)
+        finally:
+            self._reply_lock.release()
+
+    def flush(self):
+
+        '''
+        send the commands held back by batch() so far
+        '''
+
+        if self._pending:
+            pending, self._pending = self._pending, bytearray()
+            self.brick.sendall(pending)
+
+    @contextlib.contextmanager
+    def batch(self):
+
+        '''
+        collect the commands issued inside the with-block and send
+        them to EV3 in a single write when the block ends
+
+        nothing that is still held back is sent if the block raises, so
+        e.g. a motor_start is never sent without the motor_stop that
+        was meant to follow it; read_sensor and flush() send whatever
+        was collected so far
+        '''
+
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = bytearray()
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._pending = None
+
     def connect(self, conn_type):
     
         '''
@@ -177,21 +514,43 @@ class ev3:
         '''
 
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
+
+        # assemble command (opOUTPUT_POWER, opOUTPUT_START) and send to EV3
+        self._send(build_motor_start_command(layer, ports, power))
+                
+    def send_command(self, command):
+
+        '''
+        send bytes made by the build_* functions (one command or several
+        of them concatenated)
+        '''
 
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x0D\x00\x00\x00\x80\x00\x00'
+        self._send(command)
 
-        # opOUTPUT_POWER
-        comm_1 = b'\xA4' + LC0(layer) + LC0(ports) + LC1(power)
+    def compile_motor_start(self, ports, layer=0):
 
-        # opOUTPUT_START
-        comm_2 = b'\xA6' + LC0(layer) + LC0(ports)
+        '''
+        return a function that takes power and does what motor_start
+        does for these ports and layer
+        
+        the command is built only once and just its power byte is
+        replaced on each call, so use this in tight loops where only
+        the power changes
+        '''
+
+        # map ports: str->int
+        ports = _ports_mask(ports)
+
+        command = bytearray(build_motor_start_command(layer, ports, 0))
+        send = self._send
+
+        def motor_start(power):
+            command[_MOTOR_START_POWER_OFFSET] = power & 0xFF
+            send(command)
+
+        return motor_start
 
-        # assemble command and send to EV3
-        command = comm_0 + comm_1 + comm_2
-        self.brick.send(command)
-                
     def motor_stop(self, ports, stop='coast', layer=0):
  
         '''
@@ -199,20 +558,13 @@ class ev3:
         '''
 
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
 
         # map mode: str->int
-        stop = self.stops[stop]
- 
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x09\x00\x01\x00\x80\x00\x00'
-
-        # opOUTPUT_STOP
-        comm_1 = b'\xA3' + LC0(layer) + LC0(ports) + LC0(stop)
+        stop = _STOP_MODES[stop]
 
-        # assemble command and send to EV3
-        command = comm_0 + comm_1
-        self.brick.send(command)
+        # assemble command (opOUTPUT_STOP) and send to EV3
+        self._send(build_motor_stop_command(layer, ports, stop))
 
     def motor_degrees(self, ports, power, degrees, stop='brake', 
                       ramp_up=0, ramp_down=0, layer=0):
@@ -223,25 +575,15 @@ class ev3:
         '''        
 
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
 
         # map mode: str->int
-        stop = self.stops[stop]
-
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x1D\x00\x00\x00\x80\x00\x00'
+        stop = _STOP_MODES[stop]
 
-        # opOUTPUT_STEP_POWER
-        comm_1 = b'\xAC' + LC0(layer) + LC0(ports) + LC1(power) \
-                 + LC4(ramp_up) + LC4(degrees) + LC4(ramp_down) \
-                 + LC0(stop)
-    
-        # opOUTPUT_START
-        comm_2 = b'\xA6' + LC0(layer) + LC0(ports)
-
-        # assemble command and send to EV3
-        command = comm_0 + comm_1 + comm_2
-        self.brick.send(command)
+        # assemble command (opOUTPUT_STEP_POWER, opOUTPUT_START) and send 
+        # to EV3
+        self._send(build_motor_degrees_command(layer, ports, power, ramp_up, 
+                                               degrees, ramp_down, stop))
 
     def motor_time(self, ports, power, time, stop='brake', 
                    ramp_up=0, ramp_down=0, layer=0):
@@ -252,25 +594,15 @@ class ev3:
         '''        
 
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
 
         # map mode: str->int
-        stop = self.stops[stop]
+        stop = _STOP_MODES[stop]
 
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x1D\x00\x00\x00\x80\x00\x00'
-
-        # opOUTPUT_TIME_POWER
-        comm_1 = b'\xAD' + LC0(layer) + LC0(ports) + LC1(power) \
-                 + LC4(ramp_up) + LC4(time) + LC4(ramp_down) \
-                 + LC0(stop)
-    
-        # opOUTPUT_START
-        comm_2 = b'\xA6' + LC0(layer) + LC0(ports)
-
-        # assemble command and send to EV3
-        command = comm_0 + comm_1 + comm_2
-        self.brick.send(command)
+        # assemble command (opOUTPUT_TIME_POWER, opOUTPUT_START) and send 
+        # to EV3
+        self._send(build_motor_time_command(layer, ports, power, ramp_up, 
+                                            time, ramp_down, stop))
 
     def turn_degrees(self, ports, speed, turn, degrees, stop='brake', 
                            layer=0):
@@ -281,21 +613,14 @@ class ev3:
         '''
         
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
 
         # map mode: str->int
-        stop = self.stops[stop]
-
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x13\x00\x00\x00\x80\x00\x00'
-
-        # opOUTPUT_STEP_SYNC        
-        comm_1 = b'\xB0' + LC0(layer) + LC0(ports) + LC1(speed) + LC2(turn) \
-                 + LC4(degrees) + LC0(stop)
+        stop = _STOP_MODES[stop]
 
-        # assemble command and send to EV3
-        command = comm_0 + comm_1
-        self.brick.send(command)
+        # assemble command (opOUTPUT_STEP_SYNC) and send to EV3
+        self._send(build_turn_degrees_command(layer, ports, speed, turn, 
+                                              degrees, stop))
 
     def turn_time(self, ports, speed, turn, time, stop='brake', layer=0):
     
@@ -305,21 +630,14 @@ class ev3:
         '''
         
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
 
         # map mode: str->int
-        stop = self.stops[stop]
+        stop = _STOP_MODES[stop]
 
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x13\x00\x00\x00\x80\x00\x00'
-
-        # opOUTPUT_TIME_SYNC        
-        comm_1 = b'\xB0' + LC0(layer) + LC0(ports) + LC1(speed) + LC2(turn) \
-                 + LC4(time) + LC0(stop)
-
-        # assemble command and send to EV3
-        command = comm_0 + comm_1
-        self.brick.send(command)
+        # assemble command (opOUTPUT_TIME_SYNC) and send to EV3
+        self._send(build_turn_time_command(layer, ports, speed, turn, time, 
+                                           stop))
 
     def clear_tacho(self, ports, layer=0):
 
@@ -328,17 +646,10 @@ class ev3:
         '''
 
         # map ports: str->int
-        ports = sum([self.ports_to_int[port] for port in ports])
+        ports = _ports_mask(ports)
 
-        # set message size, message counter, command type, vars        
-        comm_0 = b'\x08\x00\x00\x00\x80\x00\x00'
-        
-        # opOUTPUT_CLR_COUNT
-        comm_1 = b'\xB2' + LC0(layer) + LC0(ports)
-        
-        # assemble command and send to EV3
-        command = comm_0 + comm_1
-        self.brick.send(command)
+        # assemble command (opOUTPUT_CLR_COUNT) and send to EV3
+        self._send(build_clear_tacho_command(layer, ports))
 
     def read_sensor(self, port, layer=0):
         
@@ -349,19 +660,35 @@ class ev3:
         # map ports
         port -= 1
 
-        # set message size, message counter, command type, vars
-        comm_0 = b'\x0B\x00\x00\x00\x00\x01\x00'
+        # assemble command (opINPUT_READ), send to EV3 and retrieve
+        # sensor value (byte after the reply header)
+        return self._query(build_read_sensor_command(layer, port), 6)[5]
 
-        # opINPUT_READ
-        comm_1 = b'\x9A' + LC0(layer) + LC0(port) + b'\x00\x00\x60'
+    async def read_sensor_async(self, port, layer=0):
 
-        # assemble command and send to EV3
-        command = comm_0 + comm_1
-        self.brick.send(command)
+        '''
+        read sensor (unit: percentage) without blocking the event loop
 
-        # retrieve sensor value (5th byte) and convert to int
-        sensor_data = self.brick.recv(6).decode('utf-8')
-        return int(hex(ord(sensor_data[5])), 16)
+        the command is sent right away, together with anything held
+        back by batch(); only the wait for the reply happens in a worker
+        thread, so coroutines can keep sending motor commands meanwhile
+        '''
+
+        # map ports
+        port -= 1
+
+        # assemble command (opINPUT_READ), send to EV3 and retrieve
+        # sensor value (byte after the reply header)
+        command = build_read_sensor_command(layer, port)
+        await self._acquire_reply_lock()
+        try:
+            self._send_with_pending(command)
+        except BaseException:
+            self._reply_lock.release()
+            raise
+        reply = await asyncio.get_running_loop().run_in_executor(
+            None, self._recv_reply, 6)
+        return reply[5]
 
     def play_tone(self, volume, frequency, duration):
         
@@ -378,16 +705,8 @@ class ev3:
             obs.: unit is milliseconds
         '''
         
-        # set message size, message counter, command type, vars        
-        comm_0 = b'\x0F\x00\x00\x00\x80\x00\x00'
-
-        # opSOUND
-        comm_1 = b'\x94' + LC0(1) + LC1(volume) + LC2(frequency) \
-                 + LC2(duration)        
-
-        # assemble command and send to EV3
-        command = comm_0 + comm_1
-        self.brick.send(command)
+        # assemble command (opSOUND) and send to EV3
+        self._send(build_play_tone_command(volume, frequency, duration))
 
 
     def disconnect(self):
@@ -396,4 +715,6 @@ class ev3:
         disconnect from EV3
         '''
         
-        self.brick.close()
+        if self.brick is not None:
+            self.brick.close()
+            self.brick = None